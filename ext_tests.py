@@ -34,107 +34,474 @@
 """ Script to run external tests, eg from
 https://github.com/json-patch/json-patch-tests """
 
+import argparse
+import collections
 import doctest
+import importlib
+import multiprocessing
+import os
+import pickle
+import traceback
 import unittest
 import jsonpatch
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# errors that cases marked as failing have to raise
+EXPECTED_ERRORS = (jsonpatch.JsonPatchException, jsonpatch.JsonPointerException)
+
+# kinds of test cases
+ERROR, CHECK, APPLY_ONLY = range(3)
+
+Case = collections.namedtuple(
+    'Case', ['kind', 'doc_blob', 'patch', 'expected', 'expected_blob',
+             'comment', 'compiled'])
+
+# expected documents serializing to more than this many characters are
+# compared in their canonical serialized form
+CANONICAL_THRESHOLD = 4096
+
+# every worker process gets at least this many cases, as starting the
+# processes takes about as long as running this many cases serially
+PARALLEL_THRESHOLD = 2000
+
+
+def _canonical(obj):
+    """ Serializes obj with sorted keys, preferably with orjson """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+        except TypeError:
+            pass
+
+    return jsonpatch.json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def prepare_case(test):
+    """ Classifies a test from the JSON file so it can be run directly
+
+    Returns None for tests that are not to be run at all. """
+
+    if not 'doc' in test or not 'patch' in test:
+        # incomplete
+        return None
+
+    if test.get('disabled', False):
+        # test is disabled
+        return None
+
+    comment = test.get('comment', '')
+
+    if 'error' in test:
+        kind = ERROR
+
+    # if there is no 'expected' we only verify that applying the patch
+    # does not raise an exception
+    elif 'expected' in test:
+        kind = CHECK
+
+    else:
+        kind = APPLY_ONLY
+
+    # the document is stored serialized so that every run works on a fresh
+    # copy, which is cheaper to get from the JSON decoder than from deepcopy
+    # and allows to apply the patch in place
+    doc_blob = jsonpatch.json.dumps(test['doc'])
+    expected = test.get('expected')
+    expected_blob = None
+    if kind == CHECK:
+        expected_blob = _canonical(expected)
+        if len(expected_blob) <= CANONICAL_THRESHOLD:
+            # comparing small documents directly is cheaper than serializing
+            expected_blob = None
+
+    return Case(kind, doc_blob, test['patch'], expected, expected_blob,
+                comment, None)
+
+
+def compile_case(case):
+    """ Returns the case with its patch compiled to a JsonPatch
+
+    Cases whose patch is rejected right away keep the raw patch, which is
+    then passed to apply_patch to produce the error. """
+    try:
+        compiled = jsonpatch.JsonPatch(case.patch)
+    except Exception:
+        return case
+
+    return case._replace(compiled=compiled)
+
+
+def patch_doc(case, doc):
+    """ Applies the patch of the case in place to doc """
+    if case.compiled is not None:
+        return case.compiled.apply(doc, in_place=True)
+
+    return jsonpatch.apply_patch(doc, case.patch, in_place=True)
+
+
+# cases of the test file currently run in parallel; forked worker processes
+# inherit them instead of receiving them pickled
+_shard_cases = ()
+
+
+def _run_shard(start, stop):
+    """ Runs the cases start..stop of _shard_cases in a worker process
+
+    Returns a list of (index, failure) pairs, where failure is the formatted
+    traceback or None if the case passed. """
+    driver = TestCaseTemplate('test_all')
+    results = []
+    for n in range(start, stop):
+        try:
+            driver._run(_shard_cases[n])
+        except Exception:
+            results.append((n, traceback.format_exc()))
+        else:
+            results.append((n, None))
+    return results
 
 
 class TestCaseTemplate(unittest.TestCase):
     """ A generic test case for running external tests """
 
-    def _test(self, test):
-        if not 'doc' in test or not 'patch' in test:
-            # incomplete
+    _cases = ()
+
+    # number of worker processes to run the cases in
+    jobs = 1
+
+    # stop running cases once one of them failed
+    failfast = False
+
+    # report every failing case as its own subTest instead of collecting all
+    # failures into a single one
+    subtests = os.environ.get('EXT_TESTS_SUBTESTS') == '1'
+
+    def test_all(self):
+        jobs = min(self.jobs, len(self._cases) // PARALLEL_THRESHOLD)
+        if jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            self._test_all_parallel(jobs)
             return
 
-        if test.get('disabled', False):
-            # test is disabled
+        if self.subtests:
+            for n, case in enumerate(self._cases):
+                with self.subTest(i=n):
+                    self._run(case)
             return
 
-        if 'error' in test:
-            self.assertRaises(
-                (jsonpatch.JsonPatchException, jsonpatch.JsonPointerException),
-                jsonpatch.apply_patch, test['doc'], test['patch']
-                )
+        failures = []
+        for n, case in enumerate(self._cases):
+            try:
+                self._run(case)
+            except Exception:
+                failures.append((n, traceback.format_exc()))
+                if self.failfast:
+                    break
 
-        else:
+        self._report(failures)
+
+    def _report(self, failures):
+        """ Reports the collected (index, traceback) pairs of failed cases """
+        if not failures:
+            return
+
+        if self.subtests:
+            for n, failure in failures:
+                with self.subTest(i=n):
+                    self.fail(failure)
+            return
+
+        self.fail('%d of %d cases failed\n\n' % (len(failures),
+                                                 len(self._cases)) +
+                  '\n'.join('case %d: %s' % (n, failure)
+                            for n, failure in failures))
+
+    def _test_all_parallel(self, jobs):
+        global _shard_cases
+        _shard_cases = self._cases
+
+        size = -(-len(self._cases) // jobs)
+        bounds = [(start, min(start + size, len(self._cases)))
+                  for start in range(0, len(self._cases), size)]
+
+        ctx = multiprocessing.get_context('fork')
+        results = []
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=ctx) as executor:
+                futures = [executor.submit(_run_shard, start, stop)
+                           for start, stop in bounds]
+                for future in as_completed(futures):
+                    shard_results = future.result()
+                    results.extend(shard_results)
+                    if self.failfast and \
+                            any(failure for _, failure in shard_results):
+                        for other in futures:
+                            other.cancel()
+                        break
+        finally:
+            _shard_cases = ()
+
+        self._report([(n, failure) for n, failure in sorted(results)
+                      if failure is not None])
+
+    def _apply(self, case):
+        doc = jsonpatch.json.loads(case.doc_blob)
+        try:
+            return patch_doc(case, doc)
+        except jsonpatch.JsonPatchException as jpe:
+            raise Exception(case.comment) from jpe
+
+    def _run(self, case):
+        kind = case.kind
+
+        if kind == ERROR:
+            doc = jsonpatch.json.loads(case.doc_blob)
             try:
-                res = jsonpatch.apply_patch(test['doc'], test['patch'])
-            except jsonpatch.JsonPatchException as jpe:
-                raise Exception(test.get('comment', '')) from jpe
+                patch_doc(case, doc)
+            except EXPECTED_ERRORS:
+                return
+
+            self.fail('no error raised: %s' % case.comment)
+
+        else:
+            res = self._apply(case)
+
+            if kind != CHECK:
+                return
+
+            # large documents are compared in serialized form first; as that
+            # is stricter than == (eg for 1 and 1.0), a mismatch there is
+            # checked again below
+            if case.expected_blob is not None and \
+                    _canonical(res) == case.expected_blob:
+                return
 
-            # if there is no 'expected' we only verify that applying the patch
-            # does not raise an exception
-            if 'expected' in test:
-                self.assertEqual(res, test['expected'], test.get('comment', ''))
+            # only go through unittest's assertion machinery to report a
+            # mismatch, comparing directly is enough for passing cases
+            if res != case.expected:
+                self.assertEqual(res, case.expected, case.comment)
 
 
-def make_test_case(tests):
+def make_test_case(cases):
 
     class MyTestCase(TestCaseTemplate):
-        pass
+        _cases = cases
 
-    for n, test in enumerate(tests):
-        add_test_method(MyTestCase, 'test_%d' % n, test)
+    # one test method per case is only needed if the individual tests
+    # should be listed separately, eg when collecting them
+    if os.environ.get('EXT_TESTS_PER_CASE') == '1':
+        MyTestCase.test_all = None
+        for n, case in enumerate(cases):
+            add_test_method(MyTestCase, 'test_%d' % n, case)
 
     return MyTestCase
 
 
-def add_test_method(cls, name, test):
-    setattr(cls, name, lambda self: self._test(test))
+def add_test_method(cls, name, case):
+    setattr(cls, name, lambda self: self._run(case))
+
+
+# files larger than this are parsed incrementally, if ijson is available
+STREAM_THRESHOLD = 4 * 1024 * 1024
+
+def _json_load(f):
+    """ Parses a test file, optionally with a faster JSON decoder
+
+    Setting ORJSON=1 or UJSON=1 selects the respective decoder if it is
+    installed. This only affects reading the test files, the library itself
+    always uses its own JSON handling. """
+    if os.environ.get('ORJSON') == '1' and orjson is not None:
+        return orjson.loads(f.read())
+
+    if os.environ.get('UJSON') == '1':
+        try:
+            import ujson
+        except ImportError:
+            pass
+        else:
+            return ujson.load(f)
+
+    return jsonpatch.json.load(f)
+
+
+# bump when the layout of Case changes to invalidate existing caches
+CACHE_VERSION = 4
+
 
+def _intern_patch(patch):
+    """ Interns the op codes and pointers of a patch in place
+
+    Equal strings across all loaded cases then share one object, which saves
+    memory and lets comparisons of them succeed on identity.
+    """
+    if not isinstance(patch, list):
+        return
+
+    for operation in patch:
+        if not isinstance(operation, dict):
+            continue
+
+        for member in ('op', 'path', 'from'):
+            value = operation.get(member)
+            if isinstance(value, str):
+                operation[member] = sys.intern(value)
+
+
+def _read_cache(cache_path, header):
+    """ Returns the cached cases and the number of skipped tests if the
+    cache matches header, else None """
+    try:
+        with open(cache_path, 'rb') as f:
+            if pickle.load(f) == header:
+                return pickle.load(f), pickle.load(f)
+    except Exception:
+        # missing, stale or unreadable cache
+        pass
+
+
+def _load_tests(path):
+    """ Loads the prepared cases of a test file
+
+    The prepared cases are cached in a pickle file next to the test file, so
+    that the JSON only needs to be parsed again once the test file changes.
+    """
+    st = os.stat(path)
+    header = (CACHE_VERSION, st.st_mtime_ns, st.st_size)
+    cache_path = path + '.cache.pkl'
+
+    cached = _read_cache(cache_path, header)
+
+    if cached is not None:
+        cases, skipped = cached
+
+    else:
+        with open(path, 'rb') as f:
+            if ijson is not None and st.st_size > STREAM_THRESHOLD:
+                # prepare large files case by case instead of keeping the
+                # whole parsed file in memory alongside the prepared cases
+                tests = ijson.items(f, 'item', use_float=True)
+            else:
+                tests = _json_load(f)
+
+            cases = []
+            skipped = 0
+            for test in tests:
+                case = prepare_case(test)
+                if case is None:
+                    skipped += 1
+                else:
+                    cases.append(case)
+
+        try:
+            tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(cases, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(skipped, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # caching is optional, eg the directory might not be writable
+            pass
+
+    if skipped:
+        sys.stderr.write('%s: skipped %d disabled/incomplete cases\n' %
+                         (path, skipped))
+
+    # interned strings don't survive pickling, so this is done after loading;
+    # the same goes for compiling the patches, which keeps library objects
+    # out of the cache
+    for case in cases:
+        _intern_patch(case.patch)
+
+    return [compile_case(case) for case in cases]
 
 
 modules = ['jsonpatch']
-coverage_modules = []
 
 
-def get_suite(filenames):
+def get_suite(filenames, jobs=1, failfast=False):
     suite = unittest.TestSuite()
 
     for testfile in filenames:
-        with open(testfile) as f:
-            # we use the (potentially) patched version of json.load here
-            tests = jsonpatch.json.load(f)
-            cls = make_test_case(tests)
-            suite.addTest(unittest.makeSuite(cls))
+        cls = make_test_case(_load_tests(testfile))
+        cls.jobs = jobs
+        cls.failfast = failfast
+        suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(cls))
 
     return suite
 
 
-suite = get_suite(sys.argv[1:])
+parser = argparse.ArgumentParser(description='Run external JSON Patch tests')
+parser.add_argument('files', metavar='FILE', nargs='*',
+                    help='JSON file containing test cases')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='Number of worker processes to run the cases in, '
+                         '0 for one per CPU; files with fewer than %d cases '
+                         'per process run with fewer processes or serially'
+                         % PARALLEL_THRESHOLD)
+parser.add_argument('-x', '--failfast', action='store_true',
+                    help='Stop on the first failing case')
 
-for module in modules:
-    m = __import__(module, fromlist=[module])
-    coverage_modules.append(m)
-    suite.addTest(doctest.DocTestSuite(m))
 
-runner = unittest.TextTestRunner(verbosity=1)
+def main(argv):
+    """ Runs the external tests, returns the exit status """
+    args = parser.parse_args(argv)
+    suite = get_suite(args.files, args.jobs or os.cpu_count(), args.failfast)
 
-try:
-    import coverage
-    cov = coverage.Coverage()
-except ImportError:
-    cov = None
+    # the doctests are part of the regular test suite, so they are only run
+    # here when asked for
+    run_doctests = os.environ.get('RUN_DOCTESTS') == '1'
 
-if cov is not None:
-    cov.erase()
-    cov.start()
+    coverage_modules = []
+    for module in modules:
+        m = importlib.import_module(module)
+        coverage_modules.append(m)
+        if run_doctests:
+            suite.addTest(doctest.DocTestSuite(m))
 
-result = runner.run(suite)
+    runner = unittest.TextTestRunner(verbosity=1, failfast=args.failfast)
 
-if not result.wasSuccessful():
-    sys.exit(1)
-
-if cov is not None:
-    cov.stop()
-    cov.report(coverage_modules)
-    cov.erase()
-
-if cov is None:
-    sys.stderr.write("""
+    # coverage tracing slows down the run considerably, so it is only done
+    # when explicitly requested
+    cov = None
+    if os.environ.get('COVERAGE') == '1':
+        try:
+            import coverage
+            cov = coverage.Coverage()
+        except ImportError:
+            sys.stderr.write("""
 No coverage reporting done (Python module "coverage" is missing)
 Please install the python-coverage package to get coverage reporting.
 """)
-    sys.stderr.flush()
+            sys.stderr.flush()
+
+    if cov is not None:
+        cov.erase()
+        cov.start()
+
+    result = runner.run(suite)
+
+    if not result.wasSuccessful():
+        return 1
+
+    if cov is not None:
+        cov.stop()
+        cov.report(coverage_modules)
+        cov.erase()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
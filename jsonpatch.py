@@ -57,6 +57,9 @@ from jsonpointer import JsonPointer, JsonPointerException
 _ST_ADD = 0
 _ST_REMOVE = 1
 
+# marks a missing dict key, where None would be a valid value
+_MISSING = object()
+
 
 try:
     from collections.abc import MutableMapping, MutableSequence
@@ -100,6 +103,12 @@ class JsonPatchTestFailed(JsonPatchException, AssertionError):
 
 def multidict(ordered_pairs):
     """Convert duplicate keys values to lists."""
+    ordered_pairs = list(ordered_pairs)
+    mdict = dict(ordered_pairs)
+    if len(mdict) == len(ordered_pairs):
+        # no duplicate keys, which is by far the most common case
+        return mdict
+
     # read all values into lists
     mdict = collections.defaultdict(list)
     for key, value in ordered_pairs:
@@ -117,6 +126,127 @@ def multidict(ordered_pairs):
 _jsonloads = functools.partial(json.loads, object_pairs_hook=multidict)
 
 
+# Parsed pointers by pointer class and location. Pointers are only read
+# when applying a patch, so operations with the same path can share them.
+_pointer_cache = {}
+_POINTER_CACHE_SIZE = 4096
+
+
+def _get_pointer(pointer_cls, location):
+    key = (pointer_cls, location)
+    pointer = _pointer_cache.get(key)
+    if pointer is None:
+        pointer = pointer_cls(location)
+        if len(_pointer_cache) >= _POINTER_CACHE_SIZE:
+            _pointer_cache.clear()
+        _pointer_cache[key] = pointer
+    return pointer
+
+
+# Values of these types are never modified by a patch and need no copying.
+# type(2 ** 64) is long on Python 2.
+_ATOMIC_TYPES = frozenset([
+    type(None), bool, int, type(2 ** 64), float, bytes, str,
+])
+
+
+# Equal values of these types always serialize equally.
+_EXACT_TYPES = frozenset([type(None), bool, int, type(2 ** 64), str])
+
+
+def _deepcopy(obj):
+    """Copies a JSON document.
+
+    Plain dicts and lists are copied directly, which is much faster than
+    :func:`copy.deepcopy`. Any other values are copied with
+    :func:`copy.deepcopy`.
+
+    >>> doc = {'foo': [1, {'bar': 'baz'}]}
+    >>> res = _deepcopy(doc)
+    >>> res == doc, res['foo'][1] is doc['foo'][1]
+    (True, False)
+    """
+    cls = type(obj)
+    if cls is dict:
+        return {key: value if type(value) in _ATOMIC_TYPES
+                else _deepcopy(value) for key, value in obj.items()}
+    if cls is list:
+        return [value if type(value) in _ATOMIC_TYPES else _deepcopy(value)
+                for value in obj]
+    if cls in _ATOMIC_TYPES:
+        return obj
+    return copy.deepcopy(obj)
+
+
+def _to_last(pointer, doc):
+    """Resolves pointer up to its last part, like pointer.to_last(doc).
+
+    Plain JsonPointers step into dicts directly, skipping the generic checks
+    of JsonPointer.walk(). Anything else is left to the pointer.
+    """
+    parts = pointer.parts
+    if type(pointer) is not JsonPointer or not parts:
+        return pointer.to_last(doc)
+
+    for i in range(len(parts) - 1):
+        part = parts[i]
+        child = doc.get(part, _MISSING) if type(doc) is dict else _MISSING
+        doc = pointer.walk(doc, part) if child is _MISSING else child
+
+    if type(doc) is dict:
+        return doc, parts[-1]
+    return doc, pointer.get_part(doc, parts[-1])
+
+
+def _from_pointer(operation):
+    """Returns the parsed 'from' pointer of an operation, or None if it is
+    missing or invalid."""
+    try:
+        from_ptr = operation.operation['from']
+        if not isinstance(from_ptr, operation.pointer_cls):
+            from_ptr = _get_pointer(operation.pointer_cls, from_ptr)
+    except (KeyError, TypeError, AttributeError):
+        return None
+    return from_ptr
+
+
+def _copy_path(doc, pointer, copies, removed=None):
+    """Copies doc and the containers on the way to the parent of pointer's
+    target, unless they have been copied before, so that they can be
+    modified without changing the original document.
+
+    `copies` maps the ids of all copies made so far to the copies. If
+    `removed` is a (container, key) pair, the path is resolved as if that
+    item had already been removed. Returns the copy of doc.
+    """
+    if id(doc) not in copies:
+        doc = copy.copy(doc)
+        copies[id(doc)] = doc
+
+    root = subdoc = doc
+    for part in pointer.parts[:-1]:
+        try:
+            key = pointer.get_part(subdoc, part)
+            if removed is not None and subdoc is removed[0] and \
+                    type(key) is int and type(removed[1]) is int and \
+                    key >= removed[1]:
+                key += 1
+            child = subdoc[key]
+        except (JsonPointerException, LookupError, TypeError):
+            # the operation itself reports the invalid path
+            break
+
+        if id(child) not in copies:
+            if _container_type(child) is None:
+                break
+            child = copy.copy(child)
+            copies[id(child)] = child
+            subdoc[key] = child
+        subdoc = child
+
+    return root
+
+
 def apply_patch(doc, patch, in_place=False, pointer_cls=JsonPointer):
     """Apply list of patches to specified json document.
 
@@ -184,6 +314,9 @@ def make_patch(src, dst, pointer_cls=JsonPointer):
 class PatchOperation(object):
     """A single operation inside a JSON Patch."""
 
+    __slots__ = ('pointer_cls', 'location', 'pointer', 'operation',
+                 '_path', '_key')
+
     def __init__(self, operation, pointer_cls=JsonPointer):
         self.pointer_cls = pointer_cls
 
@@ -196,16 +329,51 @@ class PatchOperation(object):
         else:
             self.location = operation['path']
             try:
-                self.pointer = self.pointer_cls(self.location)
+                self.pointer = _get_pointer(self.pointer_cls, self.location)
             except TypeError as ex:
                 raise InvalidJsonPatch("Invalid 'path'")
 
         self.operation = operation
+        self._path = self._key = None
 
     def apply(self, obj):
         """Abstract method that applies a patch operation to the specified object."""
         raise NotImplementedError('should implement the patch operation.')
 
+    def _add_value(self, obj, value):
+        """Adds value at the location of this operation."""
+        subobj, part = _to_last(self.pointer, obj)
+        container = _container_type(subobj)
+
+        if container is list:
+            if part == '-':
+                subobj.append(value)  # pylint: disable=E1103
+
+            elif type(part) is int and 0 <= part <= len(subobj):
+                subobj.insert(part, value)  # pylint: disable=E1103
+
+            elif part is None:
+                obj = value  # we're replacing the root
+
+            elif isinstance(part, int):
+                raise JsonPatchConflict("can't insert outside of list")
+
+            else:
+                raise JsonPointerException("invalid array index '{0}'".format(part))
+
+        elif container is dict:
+            if part is None:
+                obj = value  # we're replacing the root
+            else:
+                subobj[part] = value
+
+        else:
+            if part is None:
+                raise TypeError("invalid document type {0}".format(type(subobj)))
+            else:
+                raise JsonPatchConflict("unable to fully resolve json pointer {0}, part {1}".format(self.location, part))
+        return obj
+
     def __hash__(self):
         return hash(frozenset(self.operation.items()))
 
@@ -219,18 +387,27 @@ class PatchOperation(object):
 
     @property
     def path(self):
-        return '/'.join(self.pointer.parts[:-1])
+        if self._path is None:
+            self._path = '/'.join(self.pointer.parts[:-1])
+        return self._path
 
     @property
     def key(self):
-        try:
-            return int(self.pointer.parts[-1])
-        except ValueError:
-            return self.pointer.parts[-1]
+        if self._key is None:
+            try:
+                self._key = int(self.pointer.parts[-1])
+            except ValueError:
+                self._key = self.pointer.parts[-1]
+        return self._key
 
     @key.setter
     def key(self, value):
-        self.pointer.parts[-1] = str(value)
+        # the pointer might be shared with other operations, so it is
+        # replaced instead of modified
+        pointer = copy.copy(self.pointer)
+        pointer.parts = self.pointer.parts[:-1] + [str(value)]
+        self.pointer = pointer
+        self._key = None
         self.location = self.pointer.path
         self.operation['path'] = self.location
 
@@ -238,8 +415,17 @@ class PatchOperation(object):
 class RemoveOperation(PatchOperation):
     """Removes an object property or an array element."""
 
+    __slots__ = ()
+
     def apply(self, obj):
-        subobj, part = self.pointer.to_last(obj)
+        subobj, part = _to_last(self.pointer, obj)
+
+        # plain JSON containers holding the item need none of the checks below
+        cls = type(subobj)
+        if cls is dict and part in subobj or \
+                cls is list and type(part) is int and part < len(subobj):
+            del subobj[part]
+            return obj
 
         if isinstance(subobj, Sequence) and not isinstance(part, int):
             raise JsonPointerException("invalid array index '{0}'".format(part))
@@ -272,6 +458,8 @@ class RemoveOperation(PatchOperation):
 class AddOperation(PatchOperation):
     """Adds an object property or an array element."""
 
+    __slots__ = ()
+
     def apply(self, obj):
         try:
             value = self.operation["value"]
@@ -279,30 +467,7 @@ class AddOperation(PatchOperation):
             raise InvalidJsonPatch(
                 "The operation does not contain a 'value' member")
 
-        subobj, part = self.pointer.to_last(obj)
-
-        if isinstance(subobj, MutableSequence):
-            if part == '-':
-                subobj.append(value)  # pylint: disable=E1103
-
-            elif part > len(subobj) or part < 0:
-                raise JsonPatchConflict("can't insert outside of list")
-
-            else:
-                subobj.insert(part, value)  # pylint: disable=E1103
-
-        elif isinstance(subobj, MutableMapping):
-            if part is None:
-                obj = value  # we're replacing the root
-            else:
-                subobj[part] = value
-
-        else:
-            if part is None:
-                raise TypeError("invalid document type {0}".format(type(subobj)))
-            else:
-                raise JsonPatchConflict("unable to fully resolve json pointer {0}, part {1}".format(self.location, part))
-        return obj
+        return self._add_value(obj, value)
 
     def _on_undo_remove(self, path, key):
         if self.path == path:
@@ -324,6 +489,8 @@ class AddOperation(PatchOperation):
 class ReplaceOperation(PatchOperation):
     """Replaces an object property or an array element by a new value."""
 
+    __slots__ = ()
+
     def apply(self, obj):
         try:
             value = self.operation["value"]
@@ -331,19 +498,20 @@ class ReplaceOperation(PatchOperation):
             raise InvalidJsonPatch(
                 "The operation does not contain a 'value' member")
 
-        subobj, part = self.pointer.to_last(obj)
+        if not self.pointer.parts:
+            return value  # we're replacing the root
 
-        if part is None:
-            return value
+        subobj, part = _to_last(self.pointer, obj)
 
         if part == "-":
             raise InvalidJsonPatch("'path' with '-' can't be applied to 'replace' operation")
 
-        if isinstance(subobj, MutableSequence):
+        container = _container_type(subobj)
+        if container is list:
             if part >= len(subobj) or part < 0:
                 raise JsonPatchConflict("can't replace outside of list")
 
-        elif isinstance(subobj, MutableMapping):
+        elif container is dict:
             if part not in subobj:
                 msg = "can't replace a non-existent object '{0}'".format(part)
                 raise JsonPatchConflict(msg)
@@ -366,17 +534,24 @@ class ReplaceOperation(PatchOperation):
 class MoveOperation(PatchOperation):
     """Moves an object property or an array element to a new location."""
 
+    __slots__ = ('_from_path', '_from_key')
+
+    def __init__(self, operation, pointer_cls=JsonPointer):
+        super(MoveOperation, self).__init__(operation, pointer_cls=pointer_cls)
+        self._from_path = self._from_key = None
+
     def apply(self, obj):
         try:
             if isinstance(self.operation['from'], self.pointer_cls):
                 from_ptr = self.operation['from']
             else:
-                from_ptr = self.pointer_cls(self.operation['from'])
+                from_ptr = _get_pointer(self.pointer_cls,
+                                        self.operation['from'])
         except KeyError as ex:
             raise InvalidJsonPatch(
                 "The operation does not contain a 'from' member")
 
-        subobj, part = from_ptr.to_last(obj)
+        subobj, part = _to_last(from_ptr, obj)
         try:
             value = subobj[part]
         except (KeyError, IndexError) as ex:
@@ -386,41 +561,39 @@ class MoveOperation(PatchOperation):
         if self.pointer == from_ptr:
             return obj
 
-        if isinstance(subobj, MutableMapping) and \
+        if _container_type(subobj) is dict and \
                 self.pointer.contains(from_ptr):
             raise JsonPatchConflict('Cannot move values into their own children')
 
-        obj = RemoveOperation({
-            'op': 'remove',
-            'path': self.operation['from']
-        }, pointer_cls=self.pointer_cls).apply(obj)
-
-        obj = AddOperation({
-            'op': 'add',
-            'path': self.location,
-            'value': value
-        }, pointer_cls=self.pointer_cls).apply(obj)
-
-        return obj
+        # the value has just been looked up, so it can be removed directly
+        del subobj[part]
+        return self._add_value(obj, value)
 
     @property
     def from_path(self):
-        from_ptr = self.pointer_cls(self.operation['from'])
-        return '/'.join(from_ptr.parts[:-1])
+        if self._from_path is None:
+            from_ptr = _get_pointer(self.pointer_cls, self.operation['from'])
+            self._from_path = '/'.join(from_ptr.parts[:-1])
+        return self._from_path
 
     @property
     def from_key(self):
-        from_ptr = self.pointer_cls(self.operation['from'])
-        try:
-            return int(from_ptr.parts[-1])
-        except TypeError:
-            return from_ptr.parts[-1]
+        if self._from_key is None:
+            from_ptr = _get_pointer(self.pointer_cls, self.operation['from'])
+            try:
+                self._from_key = int(from_ptr.parts[-1])
+            except TypeError:
+                self._from_key = from_ptr.parts[-1]
+        return self._from_key
 
     @from_key.setter
     def from_key(self, value):
-        from_ptr = self.pointer_cls(self.operation['from'])
-        from_ptr.parts[-1] = str(value)
+        # the pointer is shared, so it is copied before modifying it
+        from_ptr = copy.copy(_get_pointer(self.pointer_cls,
+                                          self.operation['from']))
+        from_ptr.parts = from_ptr.parts[:-1] + [str(value)]
         self.operation['from'] = from_ptr.path
+        self._from_key = None
 
     def _on_undo_remove(self, path, key):
         if self.from_path == path:
@@ -452,12 +625,14 @@ class MoveOperation(PatchOperation):
 class TestOperation(PatchOperation):
     """Test value by specified location."""
 
+    __slots__ = ()
+
     def apply(self, obj):
         try:
-            subobj, part = self.pointer.to_last(obj)
-            if part is None:
-                val = subobj
+            if not self.pointer.parts:
+                val = obj
             else:
+                subobj, part = _to_last(self.pointer, obj)
                 val = self.pointer.walk(subobj, part)
         except JsonPointerException as ex:
             raise JsonPatchTestFailed(str(ex))
@@ -479,26 +654,22 @@ class TestOperation(PatchOperation):
 class CopyOperation(PatchOperation):
     """ Copies an object property or an array element to a new location """
 
+    __slots__ = ()
+
     def apply(self, obj):
         try:
-            from_ptr = self.pointer_cls(self.operation['from'])
+            from_ptr = _get_pointer(self.pointer_cls, self.operation['from'])
         except KeyError as ex:
             raise InvalidJsonPatch(
                 "The operation does not contain a 'from' member")
 
-        subobj, part = from_ptr.to_last(obj)
+        subobj, part = _to_last(from_ptr, obj)
         try:
-            value = copy.deepcopy(subobj[part])
+            value = _deepcopy(subobj[part])
         except (KeyError, IndexError) as ex:
             raise JsonPatchConflict(str(ex))
 
-        obj = AddOperation({
-            'op': 'add',
-            'path': self.location,
-            'value': value
-        }, pointer_cls=self.pointer_cls).apply(obj)
-
-        return obj
+        return self._add_value(obj, value)
 
 
 class JsonPatch(object):
@@ -558,6 +729,11 @@ class JsonPatch(object):
     ...     # document have changed, do something useful
     ...     patch.apply(old)    #doctest: +ELLIPSIS
     {...}
+
+    Operations can still be added to, removed from or replaced in
+    :attr:`patch` after the JsonPatch has been created. The 'op', 'path' and
+    'from' members of an operation are only read when it is added though, so
+    they should not be changed afterwards.
     """
     def __init__(self, patch, pointer_cls=JsonPointer):
         self.patch = patch
@@ -567,21 +743,9 @@ class JsonPatch(object):
         # is correct by retrieving each patch element.
         # Much of the validation is done in the initializer
         # though some is delayed until the patch is applied.
-        for op in self.patch:
-            # We're only checking for basestring in the following check
-            # for two reasons:
-            #
-            # - It should come from JSON, which only allows strings as
-            #   dictionary keys, so having a string here unambiguously means
-            #   someone used: {"op": ..., ...} instead of [{"op": ..., ...}].
-            #
-            # - There's no possible false positive: if someone give a sequence
-            #   of mappings, this won't raise.
-            if isinstance(op, basestring):
-                raise InvalidJsonPatch("Document is expected to be sequence of "
-                                       "operations, got a sequence of strings.")
-
-            self._get_operation(op)
+        self._built_from = None
+        self._built_ops = self._build_ops()
+        self._hash = None
 
     def __str__(self):
         """str(self) -> self.to_string()"""
@@ -596,11 +760,16 @@ class JsonPatch(object):
         return iter(self.patch)
 
     def __hash__(self):
-        return hash(tuple(self._ops))
+        ops = self._ops
+        if self._hash is None:
+            self._hash = hash(ops)
+        return self._hash
 
     def __eq__(self, other):
         if not isinstance(other, JsonPatch):
             return False
+        if self is other:
+            return True
         return self._ops == other._ops
 
     def __ne__(self, other):
@@ -668,11 +837,7 @@ class JsonPatch(object):
         json_dumper = dumps or self.json_dumper
         return json_dumper(self.patch)
 
-    @property
-    def _ops(self):
-        return tuple(map(self._get_operation, self.patch))
-
-    def apply(self, obj, in_place=False):
+    def apply(self, obj, in_place=False, copy_on_write=False):
         """Applies the patch to a given object.
 
         :param obj: Document object.
@@ -682,39 +847,152 @@ class JsonPatch(object):
                          specified `obj` or to its copy.
         :type in_place: bool
 
+        :param copy_on_write: Only copy the parts of `obj` that the patch
+                              modifies, instead of the whole document. The
+                              result then shares all unmodified values with
+                              `obj`, so changing either of them afterwards
+                              may change the other one as well. Has no
+                              effect if `in_place` is set.
+        :type copy_on_write: bool
+
         :return: Modified `obj`.
+
+        >>> doc = {'foo': {'bar': 1}, 'baz': [1, 2]}
+        >>> patch = JsonPatch([{'op': 'add', 'path': '/foo/qux', 'value': 2}])
+        >>> result = patch.apply(doc, copy_on_write=True)
+        >>> result == {'foo': {'bar': 1, 'qux': 2}, 'baz': [1, 2]}
+        True
+        >>> result['foo'] is doc['foo'], result['baz'] is doc['baz']
+        (False, True)
         """
 
-        if not in_place:
-            obj = copy.deepcopy(obj)
+        if copy_on_write and not in_place:
+            return self._apply_copy_on_write(obj)
 
+        # test operations don't modify the document, so copying it is
+        # delayed until the first other operation. A patch whose tests
+        # fail never has to copy the document at all, and neither does
+        # one that replaces the whole document first.
+        copied = in_place
         for operation in self._ops:
+            if not copied and type(operation) is not TestOperation:
+                if type(operation) is not ReplaceOperation or \
+                        operation.pointer.parts:
+                    obj = _deepcopy(obj)
+                copied = True
             obj = operation.apply(obj)
 
+        if not copied:
+            obj = _deepcopy(obj)
+
         return obj
 
+    def _apply_copy_on_write(self, obj):
+        # containers copied so far, by id, which may be modified directly
+        copies = {}
+        for index, operation in enumerate(self._ops):
+            cls = type(operation)
+            if cls is MoveOperation:
+                # the value is removed before the target is resolved, which
+                # shifts the items after it when it is taken from a list
+                removed = None
+                from_ptr = _from_pointer(operation)
+                if from_ptr is not None:
+                    obj = _copy_path(obj, from_ptr, copies)
+                    try:
+                        removed = _to_last(from_ptr, obj)
+                    except (JsonPointerException, LookupError, TypeError):
+                        pass
+                obj = _copy_path(obj, operation.pointer, copies, removed)
+
+            elif cls in (AddOperation, RemoveOperation, ReplaceOperation,
+                         CopyOperation):
+                obj = _copy_path(obj, operation.pointer, copies)
+
+            elif cls is not TestOperation:
+                # unknown operations might modify anything
+                obj = _deepcopy(obj)
+                for operation in self._ops[index:]:
+                    obj = operation.apply(obj)
+                return obj
+
+            obj = operation.apply(obj)
+
+        if not copies:
+            # nothing has been modified
+            obj = copy.copy(obj)
+
+        return obj
+
+    @property
+    def _ops(self):
+        # The operations are built once and reused for applying, hashing and
+        # comparing the patch. They are only rebuilt if a list of operations
+        # has been changed since.
+        patch = self.patch
+        if type(patch) is not list and isinstance(patch, MutableSequence):
+            patch = list(patch)
+        if type(patch) is list and patch != self._built_from:
+            self._built_ops = self._build_ops()
+            self._hash = None
+        return self._built_ops
+
+    def _build_ops(self):
+        ops = []
+        for op in self.patch:
+            # We're only checking for basestring in the following check
+            # for two reasons:
+            #
+            # - It should come from JSON, which only allows strings as
+            #   dictionary keys, so having a string here unambiguously means
+            #   someone used: {"op": ..., ...} instead of [{"op": ..., ...}].
+            #
+            # - There's no possible false positive: if someone give a sequence
+            #   of mappings, this won't raise.
+            if isinstance(op, basestring):
+                raise InvalidJsonPatch("Document is expected to be sequence of "
+                                       "operations, got a sequence of strings.")
+
+            ops.append(self._get_operation(op))
+
+        if isinstance(self.patch, MutableSequence):
+            self._built_from = list(self.patch)
+        return tuple(ops)
+
     def _get_operation(self, operation):
         if 'op' not in operation:
             raise InvalidJsonPatch("Operation does not contain 'op' member")
 
         op = operation['op']
 
-        if not isinstance(op, basestring):
-            raise InvalidJsonPatch("Operation's op must be a string")
+        # valid operations are found right away, the type of op only
+        # matters for the error message
+        try:
+            cls = self.operations.get(op)
+        except TypeError:
+            cls = None
 
-        if op not in self.operations:
+        if cls is None:
+            if not isinstance(op, basestring):
+                raise InvalidJsonPatch("Operation's op must be a string")
             raise InvalidJsonPatch("Unknown operation {0!r}".format(op))
 
-        cls = self.operations[op]
         return cls(operation, pointer_cls=self.pointer_cls)
 
 
 class DiffBuilder(object):
 
+    # Lists are compared along their longest common subsequence, unless they
+    # differ by more than this many inserted and removed items. Then their
+    # items are compared by position, which is cheaper but produces larger
+    # patches for items inserted or removed in the middle.
+    max_list_edits = 200
+
     def __init__(self, src_doc, dst_doc, dumps=json.dumps, pointer_cls=JsonPointer):
         self.dumps = dumps
         self.pointer_cls = pointer_cls
-        self.index_storage = [{}, {}]
+        self.index_storage = [collections.defaultdict(list),
+                              collections.defaultdict(list)]
         self.index_storage2 = [[], []]
         self.__root = root = []
         self.src_doc = src_doc
@@ -722,20 +1000,19 @@ class DiffBuilder(object):
         root[:] = [root, root, None]
 
     def store_index(self, value, index, st):
-        typed_key = (value, type(value))
+        typed_key = _typed_key(value)
         try:
-            storage = self.index_storage[st]
-            stored = storage.get(typed_key)
-            if stored is None:
-                storage[typed_key] = [index]
-            else:
-                storage[typed_key].append(index)
+            self.index_storage[st][typed_key].append(index)
 
         except TypeError:
             self.index_storage2[st].append((typed_key, index))
 
     def take_index(self, value, st):
-        typed_key = (value, type(value))
+        # diffs that only add or only remove items never find a counterpart
+        if not self.index_storage[st] and not self.index_storage2[st]:
+            return None
+
+        typed_key = _typed_key(value)
         try:
             stored = self.index_storage[st].get(typed_key)
             if stored:
@@ -744,7 +1021,8 @@ class DiffBuilder(object):
         except TypeError:
             storage = self.index_storage2[st]
             for i in range(len(storage)-1, -1, -1):
-                if storage[i][0] == typed_key:
+                if storage[i][0][1] is typed_key[1] and \
+                        self._equal_values(storage[i][0][0], value):
                     return storage.pop(i)[1]
 
     def insert(self, op):
@@ -759,13 +1037,6 @@ class DiffBuilder(object):
         link_next[0] = link_prev
         index[:] = []
 
-    def iter_from(self, start):
-        root = self.__root
-        curr = start[1]
-        while curr is not root:
-            yield curr[2]
-            curr = curr[1]
-
     def __iter__(self):
         root = self.__root
         curr = root[1]
@@ -777,42 +1048,70 @@ class DiffBuilder(object):
         root = self.__root
         curr = root[1]
         while curr is not root:
-            if curr[1] is not root:
-                op_first, op_second = curr[2], curr[1][2]
-                if op_first.location == op_second.location and \
-                        type(op_first) == RemoveOperation and \
-                        type(op_second) == AddOperation:
-                    yield ReplaceOperation({
+            op_first, following = curr[2], curr[1]
+            if following is not root and type(op_first) is RemoveOperation:
+                op_second = following[2]
+                if type(op_second) is AddOperation and \
+                        op_first.location == op_second.location:
+                    yield {
                         'op': 'replace',
                         'path': op_second.location,
                         'value': op_second.operation['value'],
-                    }, pointer_cls=self.pointer_cls).operation
-                    curr = curr[1][1]
+                    }
+                    curr = following[1]
                     continue
 
-            yield curr[2].operation
+            yield op_first.operation
+            curr = following
+
+    def _reaches_into(self, index):
+        # Whether an operation after index reaches into an item of the
+        # container the operation at index changes. Their paths take that
+        # operation into account, so they would be wrong if it was turned
+        # into a move.
+        prefix = index[2].location.rpartition('/')[0] + '/'
+        root = self.__root
+        curr = index[1]
+        while curr is not root:
+            op = curr[2]
+            for location in (op.location, op.operation.get('from')):
+                if location and location.startswith(prefix) and \
+                        '/' in location[len(prefix):]:
+                    return True
             curr = curr[1]
+        return False
 
     def _item_added(self, path, key, item):
+        location = _path_join(path, key)
         index = self.take_index(item, _ST_REMOVE)
+        if index is not None and self._reaches_into(index):
+            self.store_index(item, index, _ST_REMOVE)
+            index = None
+
         if index is not None:
             op = index[2]
-            if type(op.key) == int and type(key) == int:
-                for v in self.iter_from(index):
-                    op.key = v._on_undo_remove(op.path, op.key)
+            if type(key) is int and type(op.key) is int:
+                root = self.__root
+                curr = index[1]
+                op_path, op_key = op.path, op.key
+                while curr is not root:
+                    op_key = curr[2]._on_undo_remove(op_path, op_key)
+                    curr = curr[1]
+                if op_key != op.key:
+                    op.key = op_key
 
             self.remove(index)
-            if op.location != _path_join(path, key):
+            if op.location != location:
                 new_op = MoveOperation({
                     'op': 'move',
                     'from': op.location,
-                    'path': _path_join(path, key),
+                    'path': location,
                 }, pointer_cls=self.pointer_cls)
                 self.insert(new_op)
         else:
             new_op = AddOperation({
                 'op': 'add',
-                'path': _path_join(path, key),
+                'path': location,
                 'value': item,
             }, pointer_cls=self.pointer_cls)
             new_index = self.insert(new_op)
@@ -825,6 +1124,10 @@ class DiffBuilder(object):
         }, pointer_cls=self.pointer_cls)
         index = self.take_index(item, _ST_ADD)
         new_index = self.insert(new_op)
+        if index is not None and self._reaches_into(index):
+            self.store_index(item, index, _ST_ADD)
+            index = None
+
         if index is not None:
             op = index[2]
             # We can't rely on the op.key type since PatchOperation casts
@@ -832,9 +1135,15 @@ class DiffBuilder(object):
             # for numeric string dict keys while the intention is to only handle lists.
             # So we do an explicit check on the item affected by the op instead.
             added_item = op.pointer.to_last(self.dst_doc)[0]
-            if type(added_item) == list:
-                for v in self.iter_from(index):
-                    op.key = v._on_undo_add(op.path, op.key)
+            if type(added_item) is list:
+                root = self.__root
+                curr = index[1]
+                op_path, op_key = op.path, op.key
+                while curr is not root:
+                    op_key = curr[2]._on_undo_add(op_path, op_key)
+                    curr = curr[1]
+                if op_key != op.key:
+                    op.key = op_key
 
             self.remove(index)
             if new_op.location != op.location:
@@ -859,57 +1168,140 @@ class DiffBuilder(object):
         }, pointer_cls=self.pointer_cls))
 
     def _compare_dicts(self, path, src, dst):
-        src_keys = set(src.keys())
-        dst_keys = set(dst.keys())
-        added_keys = dst_keys - src_keys
-        removed_keys = src_keys - dst_keys
-
-        for key in removed_keys:
-            self._item_removed(path, str(key), src[key])
+        for key, value in src.items():
+            if key not in dst:
+                self._item_removed(path, str(key), value)
 
-        for key in added_keys:
-            self._item_added(path, str(key), dst[key])
+        for key, value in dst.items():
+            if key not in src:
+                self._item_added(path, str(key), value)
 
-        for key in src_keys & dst_keys:
-            self._compare_values(path, key, src[key], dst[key])
+        for key, value in src.items():
+            other = dst.get(key, _MISSING)
+            if other is not _MISSING:
+                self._compare_values(path, key, value, other)
 
     def _compare_lists(self, path, src, dst):
-        len_src, len_dst = len(src), len(dst)
-        max_len = max(len_src, len_dst)
-        min_len = min(len_src, len_dst)
-        for key in range(max_len):
-            if key < min_len:
-                old, new = src[key], dst[key]
-                if old == new:
-                    continue
-
-                elif isinstance(old, MutableMapping) and \
-                    isinstance(new, MutableMapping):
-                    self._compare_dicts(_path_join(path, key), old, new)
-
-                elif isinstance(old, MutableSequence) and \
-                        isinstance(new, MutableSequence):
-                    self._compare_lists(_path_join(path, key), old, new)
+        # equal items at the start and the end need no operations, so only
+        # the items in between are searched for common items
+        equal = self._equal_values
+        lsrc, ldst = len(src), len(dst)
+        start, shortest = 0, min(lsrc, ldst)
+        while start < shortest and equal(src[start], dst[start]):
+            start += 1
+        src_end, dst_end = lsrc, ldst
+        while src_end > start and dst_end > start and \
+                equal(src[src_end - 1], dst[dst_end - 1]):
+            src_end -= 1
+            dst_end -= 1
+
+        if start == src_end and start == dst_end:
+            return
 
-                else:
-                    self._item_removed(path, key, old)
-                    self._item_added(path, key, new)
+        matches = _longest_common_subseq(src[start:src_end],
+                                         dst[start:dst_end],
+                                         self.max_list_edits, equal)
+        if matches is None:
+            # too many differences, compare the items by their position
+            self._compare_list_range(path, src, dst, start, src_end,
+                                     start, dst_end)
+            return
 
-            elif len_src > len_dst:
-                self._item_removed(path, len_dst, src[key])
+        # the items between two common items are compared with each other
+        src_start = dst_start = start
+        for src_match, dst_match in matches + [(src_end - start,
+                                                dst_end - start)]:
+            src_match += start
+            dst_match += start
+            if src_start < src_match or dst_start < dst_match:
+                self._compare_list_range(path, src, dst, src_start, src_match,
+                                         dst_start, dst_match)
+            src_start, dst_start = src_match + 1, dst_match + 1
+
+    def _compare_list_range(self, path, src, dst, src_start, src_end,
+                            dst_start, dst_end):
+        # All items before the range have already been made equal, so the
+        # item src[src_start + i] currently is at position dst_start + i.
+        common = min(src_end - src_start, dst_end - dst_start)
+        for i in range(common):
+            key = dst_start + i
+            old, new = src[src_start + i], dst[key]
+            if self._equal_values(old, new):
+                continue
+
+            container = _container_type(old)
+            if container is dict and _container_type(new) is dict:
+                self._compare_dicts(path + '/' + str(key), old, new)
+
+            elif container is list and _container_type(new) is list:
+                self._compare_lists(path + '/' + str(key), old, new)
 
             else:
-                self._item_added(path, key, dst[key])
+                self._item_removed(path, key, old)
+                self._item_added(path, key, new)
+
+        for old in src[src_start + common:src_end]:
+            self._item_removed(path, dst_start + common, old)
+
+        for key in range(dst_start + common, dst_end):
+            self._item_added(path, key, dst[key])
+
+    def _equal_values(self, src, dst):
+        # Like in _compare_values, values only count as equal if they are
+        # equal as JSON, as src == dst would not tell 1 and True apart.
+        # Plain containers are compared item by item, so that equal
+        # subtrees don't have to be serialized.
+        if src is dst:
+            return True
+
+        cls = type(src)
+        if cls is type(dst):
+            if cls in _EXACT_TYPES:
+                return src == dst
+
+            if cls is float:
+                # 0.0 == -0.0
+                return src == dst and (src != 0 or repr(src) == repr(dst))
+
+            if cls is dict:
+                if len(src) != len(dst):
+                    return False
+                for key, value in src.items():
+                    other = dst.get(key, _MISSING)
+                    if other is _MISSING or \
+                            not self._equal_values(value, other):
+                        return False
+                return True
+
+            if cls is list:
+                if len(src) != len(dst):
+                    return False
+                for value, other in zip(src, dst):
+                    if not self._equal_values(value, other):
+                        return False
+                return True
+
+        return src == dst and self.dumps(src) == self.dumps(dst)
 
     def _compare_values(self, path, key, src, dst):
-        if isinstance(src, MutableMapping) and \
-                isinstance(dst, MutableMapping):
+        # unchanged subtrees are often shared between both documents
+        if src is dst:
+            return
+
+        container = _container_type(src)
+        if container is dict and _container_type(dst) is dict:
             self._compare_dicts(_path_join(path, key), src, dst)
 
-        elif isinstance(src, MutableSequence) and \
-                isinstance(dst, MutableSequence):
+        elif container is list and _container_type(dst) is list:
             self._compare_lists(_path_join(path, key), src, dst)
 
+        # Equal values of the same type serialize equally, except for floats
+        # (0.0 == -0.0), so unchanged strings, numbers and so on can be
+        # skipped without serializing them.
+        elif type(src) is type(dst) and type(src) in _EXACT_TYPES and \
+                src == dst:
+            return
+
         # To ensure we catch changes to JSON, we can't rely on a simple
         # src == dst, because it would not recognize the difference between
         # 1 and True, among other things. Using json.dumps is the most
@@ -924,8 +1316,105 @@ class DiffBuilder(object):
             self._item_replaced(path, key, dst)
 
 
+def _typed_key(value):
+    """Returns the key under which DiffBuilder stores value.
+
+    Values that compare equal in Python but differ in JSON, like 1 and True
+    or 0.0 and -0.0, get different keys.
+    """
+    if type(value) is float:
+        return value, float, repr(value)
+    return value, type(value)
+
+
+def _container_type(value):
+    """Returns dict for mappings, list for sequences and None otherwise.
+
+    The exact JSON types are checked first, as they are much faster to
+    recognize than the abstract base classes.
+    """
+    cls = type(value)
+    if cls is dict or cls is list:
+        return cls
+    if cls in _ATOMIC_TYPES:
+        return None
+    if isinstance(value, MutableMapping):
+        return dict
+    if isinstance(value, MutableSequence):
+        return list
+    return None
+
+
+def _longest_common_subseq(src, dst, max_edits, equal):
+    """Returns the longest common subsequence of two lists as a list of
+    (src index, dst index) pairs, using Myers' O((N+M)D) difference algorithm.
+    Items are compared with `equal`.
+
+    Returns None if the lists differ by more than `max_edits` inserted and
+    removed items.
+
+    >>> _longest_common_subseq([1, 2, 3, 4], [2, 5, 3], 10, lambda a, b: a == b)
+    [(1, 0), (2, 2)]
+    """
+    lsrc, ldst = len(src), len(dst)
+    max_d = min(lsrc + ldst, max_edits)
+
+    # furthest reaching src index for every diagonal k = src index - dst index,
+    # stored at v[k + offset], and one snapshot per number of edits for
+    # tracing back the path
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+
+    for d in range(max_d + 1):
+        trace.append(v[:])
+        for k in range(offset - d, offset + d + 1, 2):
+            if k == offset - d or (k != offset + d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k + offset
+            while x < lsrc and y < ldst and \
+                    (src[x] is dst[y] or equal(src[x], dst[y])):
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= lsrc and y >= ldst:
+                return _trace_common_subseq(trace, offset, lsrc, ldst)
+
+    return None
+
+
+def _trace_common_subseq(trace, offset, x, y):
+    matches = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y + offset
+        if k == offset - d or (k != offset + d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k + offset
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+        x, y = prev_x, prev_y
+
+    matches.reverse()
+    return matches
+
+
 def _path_join(path, key):
     if key is None:
         return path
 
-    return path + '/' + str(key).replace('~', '~0').replace('/', '~1')
+    # list indices never need escaping
+    if type(key) is int:
+        return path + '/' + str(key)
+
+    key = str(key)
+    if '~' in key or '/' in key:
+        key = key.replace('~', '~0').replace('/', '~1')
+    return path + '/' + key
@@ -3,6 +3,7 @@
 
 from __future__ import unicode_literals
 
+import collections
 import json
 import decimal
 import doctest
@@ -60,6 +61,86 @@ class ApplyPatchTestCase(unittest.TestCase):
         res = jsonpatch.apply_patch(obj, [{'op': 'add', 'path': '/baz', 'value': 'qux'}])
         self.assertTrue(obj is not res)
 
+    def test_apply_patch_to_deep_copy(self):
+        obj = {'foo': [{'bar': 1}], 'baz': collections.OrderedDict(a=[1])}
+        res = jsonpatch.apply_patch(obj, [
+            {'op': 'add', 'path': '/foo/0/qux', 'value': 2},
+            {'op': 'add', 'path': '/baz/a/-', 'value': 2},
+        ])
+        self.assertEqual(obj, {'foo': [{'bar': 1}], 'baz': {'a': [1]}})
+        self.assertEqual(res, {'foo': [{'bar': 1, 'qux': 2}],
+                               'baz': {'a': [1, 2]}})
+        self.assertIsInstance(res['baz'], collections.OrderedDict)
+
+    def test_apply_patch_from_string_duplicate_keys(self):
+        obj = {'foo': 'bar'}
+        patch = '[{"op": "add", "path": "/baz", "value": {"a": 1, "a": 2, "b": 3}}]'
+        res = jsonpatch.apply_patch(obj, patch)
+        self.assertEqual(res['baz'], {'a': [1, 2], 'b': 3})
+
+    def test_copy_is_independent(self):
+        obj = {'foo': {'bar': [1]}, 'baz': 'qux'}
+        res = jsonpatch.apply_patch(obj, [
+            {'op': 'copy', 'from': '/foo', 'path': '/copy'},
+            {'op': 'copy', 'from': '/baz', 'path': '/foo/baz'},
+            {'op': 'add', 'path': '/copy/bar/-', 'value': 2},
+        ])
+        self.assertEqual(res, {'foo': {'bar': [1], 'baz': 'qux'},
+                               'copy': {'bar': [1, 2]}, 'baz': 'qux'})
+
+    def test_apply_patch_with_test_to_copy(self):
+        obj = {'foo': 'bar'}
+        res = jsonpatch.apply_patch(obj, [
+            {'op': 'test', 'path': '/foo', 'value': 'bar'},
+            {'op': 'add', 'path': '/baz', 'value': 'qux'},
+        ])
+        self.assertEqual(obj, {'foo': 'bar'})
+        self.assertEqual(res, {'foo': 'bar', 'baz': 'qux'})
+
+        res = jsonpatch.apply_patch(obj, [{'op': 'test', 'path': '/foo', 'value': 'bar'}])
+        self.assertEqual(res, obj)
+        self.assertTrue(obj is not res)
+
+    def test_apply_root_replace_to_copy(self):
+        class Uncopyable(object):
+            def __deepcopy__(self, memo):
+                raise AssertionError('the document should not be copied')
+
+        obj = {'foo': Uncopyable()}
+        patch = jsonpatch.JsonPatch([
+            {'op': 'test', 'path': '', 'value': obj},
+            {'op': 'replace', 'path': '', 'value': {'bar': [1]}},
+            {'op': 'add', 'path': '/bar/-', 'value': 2},
+        ])
+        res = patch.apply(obj)
+        self.assertEqual(res, {'bar': [1, 2]})
+        self.assertEqual(list(obj), ['foo'])
+
+    def test_apply_copy_on_write(self):
+        obj = {'foo': {'bar': [1, 2]}, 'baz': {'qux': 1}}
+        patch = jsonpatch.JsonPatch([
+            {'op': 'add', 'path': '/foo/bar/-', 'value': 3},
+            {'op': 'copy', 'from': '/baz', 'path': '/copy'},
+            {'op': 'replace', 'path': '/copy/qux', 'value': 2},
+        ])
+        res = patch.apply(obj, copy_on_write=True)
+        self.assertEqual(obj, {'foo': {'bar': [1, 2]}, 'baz': {'qux': 1}})
+        self.assertEqual(res, {'foo': {'bar': [1, 2, 3]}, 'baz': {'qux': 1},
+                               'copy': {'qux': 2}})
+        self.assertTrue(res['baz'] is obj['baz'])
+
+    def test_apply_copy_on_write_move(self):
+        # the target is resolved after removing the moved item
+        obj = ['a', {'b': 1}, {'c': 2}]
+        patch = jsonpatch.JsonPatch([
+            {'op': 'move', 'from': '/0', 'path': '/0/d'},
+            {'op': 'test', 'path': '/1', 'value': {'c': 2}},
+        ])
+        res = patch.apply(obj, copy_on_write=True)
+        self.assertEqual(obj, ['a', {'b': 1}, {'c': 2}])
+        self.assertEqual(res, [{'b': 1, 'd': 'a'}, {'c': 2}])
+        self.assertTrue(res[1] is obj[2])
+
     def test_apply_patch_to_same_instance(self):
         obj = {'foo': 'bar'}
         res = jsonpatch.apply_patch(obj, [{'op': 'add', 'path': '/baz', 'value': 'qux'}],
@@ -109,6 +190,16 @@ class ApplyPatchTestCase(unittest.TestCase):
         res = jsonpatch.apply_patch(obj, [{'op': 'add', 'path': '', 'value': new_obj}])
         self.assertTrue(res, new_obj)
 
+    def test_add_replace_whole_list_document(self):
+        obj = ['foo', 'bar']
+        res = jsonpatch.apply_patch(obj, [{'op': 'add', 'path': '', 'value': {'baz': 'qux'}}])
+        self.assertEqual(res, {'baz': 'qux'})
+
+    def test_add_outside_of_list(self):
+        obj = {'foo': ['bar']}
+        patch = [{'op': 'add', 'path': '/foo/2', 'value': 'qux'}]
+        self.assertRaises(jsonpatch.JsonPatchConflict, jsonpatch.apply_patch, obj, patch)
+
     def test_replace_array_item(self):
         obj = {'foo': ['bar', 'qux', 'baz']}
         res = jsonpatch.apply_patch(obj, [{'op': 'replace', 'path': '/foo/1',
@@ -275,6 +366,16 @@ class EqualityTestCase(unittest.TestCase):
         self.assertNotEqual(hash(patch1), hash(patch2))
 
 
+    def test_patch_hash_cached(self):
+        patch1 = jsonpatch.JsonPatch([{'op': 'test', 'path': '/test'}])
+        patch2 = jsonpatch.JsonPatch([{'op': 'test', 'path': '/test'}])
+        patch3 = jsonpatch.JsonPatch([{'op': 'test', 'path': '/test1'}])
+        self.assertEqual(hash(patch1), hash(patch1))
+        self.assertEqual(len({patch1, patch2, patch3}), 2)
+        self.assertEqual(patch1, patch2)
+        self.assertNotEqual(patch1, patch3)
+
+
     def test_patch_neq_other_objs(self):
         p = [{'op': 'test', 'path': '/test'}]
         patch = jsonpatch.JsonPatch(p)
@@ -383,9 +484,7 @@ class MakePatchTestCase(unittest.TestCase):
                    }
         self.assertEqual(expected, res)
 
-    # TODO: this test is currently disabled, as the optimized patch is
-    # not ideal
-    def _test_should_just_add_new_item_not_rebuild_all_list(self):
+    def test_should_just_add_new_item_not_rebuild_all_list(self):
         src = {'foo': [1, 2, 3]}
         dst = {'foo': [3, 1, 2, 3]}
         patch = list(jsonpatch.make_patch(src, dst))
@@ -456,6 +555,26 @@ class MakePatchTestCase(unittest.TestCase):
         res = jsonpatch.apply_patch(src, patch)
         self.assertEqual(res, dst)
 
+    def test_shared_subtree(self):
+        # identical values are skipped without serializing them
+        shared = object()
+        src = {'foo': shared, 'bar': 1}
+        dst = {'foo': shared, 'bar': 2}
+        patch = jsonpatch.make_patch(src, dst)
+        self.assertEqual(patch.patch, [{'op': 'replace', 'path': '/bar', 'value': 2}])
+
+    def test_equal_scalars(self):
+        src = {'a': 'x', 'b': 1, 'c': None, 'd': True, 'e': 0.0}
+        dst = {'a': 'x', 'b': 1, 'c': None, 'd': True, 'e': -0.0}
+        patch = jsonpatch.make_patch(src, dst)
+        self.assertEqual(patch.patch, [{'op': 'replace', 'path': '/e', 'value': -0.0}])
+
+    def test_mapping_subclass(self):
+        src = collections.OrderedDict([('foo', [1, 2])])
+        dst = {'foo': [1, 2, 3]}
+        patch = jsonpatch.make_patch(src, dst)
+        self.assertEqual(patch.patch, [{'op': 'add', 'path': '/foo/2', 'value': 3}])
+
     def test_list_in_dict(self):
         """ Test patch creation with a list within a dict, as reported in #74
 
@@ -511,6 +630,33 @@ class MakePatchTestCase(unittest.TestCase):
         self.assertEqual(res, dst)
         self.assertIsInstance(res['A'], float)
 
+    def test_list_items_equal_in_python_only(self):
+        """List items like 1 and True are not common to both lists"""
+        for src, dst in [([1, 'x'], ['y', True]), ([0, 'x'], ['y', False])]:
+            patch = jsonpatch.make_patch(src, dst)
+            res = jsonpatch.apply_patch(src, patch)
+            self.assertEqual(res, dst)
+            self.assertIsInstance(res[1], bool)
+
+    def test_moved_list_items_equal_in_python_only(self):
+        """Removed and added items like 0.0 and -0.0 are not a move"""
+        for src, dst in [([False, 0.0], [-0.0, [2]]),
+                         ([[1], 'x'], ['y', [True]])]:
+            patch = jsonpatch.make_patch(src, dst)
+            res = jsonpatch.apply_patch(src, patch)
+            self.assertEqual(json.dumps(res), json.dumps(dst))
+
+    def test_move_from_before_nested_changes(self):
+        """Items are not moved past changes inside their later siblings"""
+        cases = [
+            (['a', 'b', [1]], ['b', ['a']]),
+            ([[1, [2], {'c': 0.0, '/': 'y'}]], [[1, 0.0, [2], {'f': 3}]]),
+        ]
+        for src, dst in cases:
+            patch = jsonpatch.make_patch(src, dst)
+            res = jsonpatch.apply_patch(src, patch)
+            self.assertEqual(res, dst)
+
     def test_issue119(self):
         """Make sure it avoids casting numeric str dict key to int"""
         src = [
@@ -730,6 +876,24 @@ class ListTests(unittest.TestCase):
         res = patch.apply(src)
         self.assertEqual(res, dst)
 
+    def test_remove_from_middle(self):
+        src = {'foo': [1, 2, 3, 4, 5]}
+        dst = {'foo': [1, 2, 4, 5]}
+        patch = jsonpatch.make_patch(src, dst)
+        self.assertEqual(patch.patch, [{'op': 'remove', 'path': '/foo/2'}])
+        self.assertEqual(patch.apply(src), dst)
+
+    def test_compare_by_position_beyond_max_list_edits(self):
+        src = [1, 2, 3, 4, 5]
+        dst = [0, 1, 2, 3, 4, 5, 6]
+        old_max = jsonpatch.DiffBuilder.max_list_edits
+        jsonpatch.DiffBuilder.max_list_edits = 1
+        try:
+            patch = jsonpatch.make_patch(src, dst)
+        finally:
+            jsonpatch.DiffBuilder.max_list_edits = old_max
+        self.assertEqual(patch.apply(src), dst)
+
 
 class InvalidInputTests(unittest.TestCase):
 
@@ -851,6 +1015,74 @@ class UtilityMethodTests(unittest.TestCase):
         self.assertEqual(add, add2)
         self.assertNotEqual(add, rm)
 
+    def test_operations_have_no_dict(self):
+        patch = jsonpatch.JsonPatch([
+            {'op': 'add', 'path': '/foo', 'value': 1},
+            {'op': 'remove', 'path': '/foo'},
+            {'op': 'replace', 'path': '', 'value': {'foo': 1}},
+            {'op': 'move', 'from': '/foo', 'path': '/bar'},
+            {'op': 'copy', 'from': '/bar', 'path': '/foo'},
+            {'op': 'test', 'path': '/foo', 'value': 1},
+        ])
+        for op in patch._ops:
+            self.assertFalse(hasattr(op, '__dict__'))
+
+    def test_move_operations_share_from_pointer(self):
+        op1 = jsonpatch.MoveOperation({'op': 'move', 'from': '/foo/1', 'path': '/bar'})
+        op2 = jsonpatch.MoveOperation({'op': 'move', 'from': '/foo/1', 'path': '/baz'})
+        self.assertEqual(op1.from_key, 1)
+
+        op1.from_key = 2
+        self.assertEqual(op1.operation['from'], '/foo/2')
+        self.assertEqual(op1.from_key, 2)
+        self.assertEqual(op2.operation['from'], '/foo/1')
+        self.assertEqual(op2.from_key, 1)
+        self.assertEqual(op2.apply({'foo': [1, 2]}), {'foo': [1], 'baz': 2})
+
+    def test_operations_are_reused(self):
+        patch = jsonpatch.JsonPatch([{'op': 'add', 'path': '/foo', 'value': 1}])
+        ops = patch._ops
+        self.assertEqual(patch.apply({}), {'foo': 1})
+        self.assertEqual(patch.apply({'foo': 0}), {'foo': 1})
+        self.assertIs(patch._ops, ops)
+
+    def test_operations_added_later(self):
+        patch = jsonpatch.JsonPatch([{'op': 'add', 'path': '/foo', 'value': 1}])
+        other = jsonpatch.JsonPatch([{'op': 'add', 'path': '/foo', 'value': 1}])
+        self.assertEqual(hash(patch), hash(other))
+        patch.patch.append({'op': 'add', 'path': '/bar', 'value': 2})
+        self.assertEqual(patch.apply({}), {'foo': 1, 'bar': 2})
+        self.assertNotEqual(patch, other)
+        patch.patch[1] = {'op': 'add', 'path': '/baz', 'value': 3}
+        self.assertEqual(patch.apply({}), {'foo': 1, 'baz': 3})
+        del patch.patch[1]
+        self.assertEqual(patch, other)
+        self.assertEqual(hash(patch), hash(other))
+
+    def test_patch_equality_after_value_change(self):
+        patch1 = jsonpatch.JsonPatch([{'op': 'add', 'path': '/foo', 'value': 1}])
+        patch2 = jsonpatch.JsonPatch([{'op': 'add', 'path': '/foo', 'value': 2}])
+        self.assertNotEqual(hash(patch1), hash(patch2))
+        self.assertNotEqual(patch1, patch2)
+        patch1.patch[0]['value'] = 2
+        self.assertEqual(patch1, patch2)
+
+    def test_operations_share_pointer(self):
+        op1 = jsonpatch.RemoveOperation({'op': 'remove', 'path': '/foo/1'})
+        op2 = jsonpatch.RemoveOperation({'op': 'remove', 'path': '/foo/1'})
+        self.assertIs(op1.pointer, op2.pointer)
+
+        self.assertEqual(op1.key, 1)
+        self.assertEqual(hash(op1), hash(op2))
+        op1.key = 2
+        self.assertEqual(op1.key, 2)
+        self.assertEqual(hash(op1), hash(jsonpatch.RemoveOperation(
+            {'op': 'remove', 'path': '/foo/2'})))
+        self.assertEqual(op1.location, '/foo/2')
+        self.assertEqual(op1.operation['path'], '/foo/2')
+        self.assertEqual(op2.location, '/foo/1')
+        self.assertEqual(op2.pointer.path, '/foo/1')
+
     def test_add_operation_structure(self):
         with self.assertRaises(jsonpatch.InvalidJsonPatch):
             jsonpatch.AddOperation({'path': '/'}).apply({})